@@ -1,11 +1,18 @@
 import os
+import math
+import logging
 import time
-import json
+import queue
+import asyncio
 import hashlib
 import sqlite3
 import threading
-import requests
 import tempfile
+from typing import Optional
+
+import httpx
+import orjson
+from cachetools import TTLCache
 
 from gradio_client import Client, handle_file
 from fastapi import FastAPI, HTTPException, UploadFile, File
@@ -18,6 +25,9 @@ from gradio_client import Client
 # ----------------- ENV -----------------
 SERPAPI_KEY = os.getenv("SERPAPI_KEY", "").strip()
 HF_SPACE_URL = os.getenv("HF_SPACE_URL", "").strip()
+LOG_ROUTES = os.getenv("LOG_ROUTES", "").strip()
+
+logger = logging.getLogger(__name__)
 
 # ----------------- settings -----------------
 DB_PATH = "cache.sqlite3"
@@ -25,6 +35,14 @@ TTL_SECONDS_DEFAULT = 6 * 60 * 60
 TTL_SECONDS_FALLBACK = 24 * 60 * 60
 MIN_SECONDS_BETWEEN_CALLS = 2
 MAX_CALLS_PER_DAY = 200
+LIMITER_BURST = 1
+DB_READERS = 4
+MEM_CACHE_SIZE = 1024
+CACHE_FLUSH_MAX_ITEMS = 100
+CACHE_FLUSH_INTERVAL_SECONDS = 0.2
+SERPAPI_MAX_RETRY_WAIT_SECONDS = 30
+CACHE_PRUNE_INTERVAL_SECONDS = 10 * 60
+DB_BUSY_TIMEOUT_SECONDS = 30
 
 # ----------------- app -----------------
 app = FastAPI()
@@ -37,32 +55,62 @@ async def root():
         return f.read()
 
 
+# ----------------- shared http client -----------------
+_http = httpx.AsyncClient(
+    timeout=30,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+)
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await _http.aclose()
+    await asyncio.to_thread(_cache_flush)
+
+
 # ----------------- global limiter state -----------------
+# token bucket, refilled lazily at 1 token per MIN_SECONDS_BETWEEN_CALLS
 _limiter_lock = threading.Lock()
-_last_call_ts = 0.0
+_bucket_tokens = float(LIMITER_BURST)
+_bucket_ts = 0.0
 _day_key = None
 _day_calls = 0
 
 
-def _today_key_local() -> str:
-    return time.strftime("%Y-%m-%d", time.localtime())
+# the formatted day is cached and only rebuilt once the next local midnight passes
+_cached_day_str = ""
+_next_midnight = 0.0
+
+
+def _today_key_local(now: float) -> str:
+    global _cached_day_str, _next_midnight
+    if now >= _next_midnight:
+        lt = time.localtime(now)
+        _cached_day_str = time.strftime("%Y-%m-%d", lt)
+        # mktime normalises mday + 1 and resolves DST for that midnight
+        _next_midnight = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+    return _cached_day_str
 
 
 def _limiter_allow() -> tuple[bool, dict]:
-    global _last_call_ts, _day_key, _day_calls
+    global _bucket_tokens, _bucket_ts, _day_key, _day_calls
+    now = time.time()
+    tk = _today_key_local(now)
     with _limiter_lock:
-        now = time.time()
-        tk = _today_key_local()
         if _day_key != tk:
             _day_key = tk
             _day_calls = 0
-            _last_call_ts = 0.0
-        wait_needed = max(0.0, MIN_SECONDS_BETWEEN_CALLS - (now - _last_call_ts))
+            _bucket_tokens = float(LIMITER_BURST)
+            _bucket_ts = now
         if _day_calls >= MAX_CALLS_PER_DAY:
             return False, {"reason": "daily_cap", "day_calls": _day_calls, "day_cap": MAX_CALLS_PER_DAY}
-        if wait_needed > 0:
+        tokens = min(float(LIMITER_BURST), _bucket_tokens + (now - _bucket_ts) / MIN_SECONDS_BETWEEN_CALLS)
+        _bucket_ts = now
+        if tokens < 1.0:
+            _bucket_tokens = tokens
+            wait_needed = (1.0 - tokens) * MIN_SECONDS_BETWEEN_CALLS
             return False, {"reason": "min_interval", "retry_after_seconds": int(wait_needed) + 1}
-        _last_call_ts = now
+        _bucket_tokens = tokens - 1.0
         _day_calls += 1
         return True, {"day_calls": _day_calls, "day_cap": MAX_CALLS_PER_DAY}
 
@@ -70,68 +118,189 @@ def _limiter_allow() -> tuple[bool, dict]:
 # ----------------- sqlite cache -----------------
 _db_lock = threading.Lock()
 
+# sqlite3 keeps an LRU of prepared statements per connection, keyed by SQL text
+SQL_CACHE_GET = "SELECT ts, payload, etag FROM cache WHERE k=?"
+SQL_CACHE_SET = "INSERT OR REPLACE INTO cache(k, ts, payload, etag) VALUES(?,?,?,?)"
+SQL_CACHE_PRUNE = "DELETE FROM cache WHERE ts < ?"
+SQL_CACHE_CLEAR = "DELETE FROM cache"
+
 
 def _db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS cache (
-            k TEXT PRIMARY KEY,
-            query TEXT NOT NULL,
-            lim INTEGER NOT NULL,
-            ts INTEGER NOT NULL,
-            payload TEXT NOT NULL
-        )
-    """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_ts ON cache(ts)")
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+    # must precede the first write to a new file; older files are converted below
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    # query and limit live only in the hashed key; older layouts are just dropped.
+    # IMMEDIATE so workers starting together migrate one at a time
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cols = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+        if cols and cols != {"k", "ts", "payload", "etag"}:
+            conn.execute("DROP TABLE IF EXISTS cache")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                k BLOB PRIMARY KEY,
+                ts INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                etag TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_ts ON cache(ts)")
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.OperationalError as e:
+            # another worker holds the database; a later start converts it
+            print("Cache vacuum skipped:", repr(e))
     return conn
 
 
 _conn = _db()
 
 
-def _cache_key(query: str, limit: int) -> str:
-    return hashlib.sha256(f"{query}\n{limit}".encode("utf-8")).hexdigest()
+def _db_reader():
+    conn = sqlite3.connect(DB_PATH, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only=1")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")
+    return conn
 
 
-def _cache_get(query: str, limit: int):
-    k = _cache_key(query, limit)
-    with _db_lock:
-        row = _conn.execute("SELECT ts, payload FROM cache WHERE k=?", (k,)).fetchone()
-    if not row:
-        return None
-    ts, payload = row
-    try:
-        data = json.loads(payload)
-    except Exception:
-        return None
-    age = int(time.time()) - int(ts)
-    data.setdefault("debug", {})
-    data["debug"]["cache"] = "HIT"
-    data["debug"]["cache_age_seconds"] = age
-    return {"k": k, "ts": int(ts), "age": age, "data": data}
+_readers: queue.Queue = queue.Queue()
+for _ in range(DB_READERS):
+    _readers.put(_db_reader())
+
+
+def _cache_key(query: str, limit: int) -> bytes:
+    return hashlib.blake2b(f"{query}\n{limit}".encode("utf-8"), digest_size=16).digest()
 
 
-def _cache_set(query: str, limit: int, data: dict):
+# parsed payloads for recent keys, so repeat hits skip sqlite and json
+_mem_cache = TTLCache(maxsize=MEM_CACHE_SIZE, ttl=TTL_SECONDS_DEFAULT)
+_mem_lock = threading.RLock()
+
+
+def _cache_get(query: str, limit: int):
+    k = _cache_key(query, limit)
+    with _mem_lock:
+        hit = _mem_cache.get(k)
+    if hit is None:
+        gen = _cache_generation
+        reader = _readers.get()
+        try:
+            row = reader.execute(SQL_CACHE_GET, (k,)).fetchone()
+        finally:
+            _readers.put(reader)
+        if not row:
+            return None
+        ts, payload, etag = row
+        try:
+            hit = (int(ts), etag, orjson.loads(payload))
+        except Exception:
+            return None
+        with _mem_lock:
+            # a clear that ran during the read must not be undone from memory
+            if gen == _cache_generation:
+                _mem_cache[k] = hit
+    ts, etag, cached = hit
+    age = int(time.time()) - ts
+    # shallow copy: callers only touch top-level keys and debug, never the shared items
+    data = {**cached, "debug": {**cached.get("debug", {}), "cache": "HIT", "cache_age_seconds": age}}
+    return {"k": k, "ts": ts, "age": age, "etag": etag, "data": data}
+
+
+def _cache_set(query: str, limit: int, data: dict, etag: Optional[str] = None):
     k = _cache_key(query, limit)
     ts = int(time.time())
-    payload = json.dumps(data, ensure_ascii=False)
-    with _db_lock:
-        _conn.execute(
-            "INSERT OR REPLACE INTO cache(k, query, lim, ts, payload) VALUES(?,?,?,?,?)",
-            (k, query, int(limit), ts, payload),
-        )
-        _conn.commit()
+    payload = orjson.dumps(data)
+    gen = _cache_generation
+    with _mem_lock:
+        if gen == _cache_generation:
+            _mem_cache[k] = (ts, etag, {**data, "debug": dict(data.get("debug", {}))})
+    _write_queue.put((gen, k, ts, payload, etag))
+
+
+# writes are coalesced and flushed in one transaction by a background thread.
+# each row carries the generation it was queued in; _cache_clear bumps the
+# generation so rows queued (or already taken by the writer) before a clear are dropped.
+_write_queue: queue.Queue = queue.Queue()
+_cache_generation = 0
+
+
+def _cache_writer():
+    while True:
+        batch = []
+        flushed = None
+        item = _write_queue.get()
+        deadline = time.monotonic() + CACHE_FLUSH_INTERVAL_SECONDS
+        while True:
+            if isinstance(item, threading.Event):
+                flushed = item
+                break
+            batch.append(item)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= CACHE_FLUSH_MAX_ITEMS or remaining <= 0:
+                break
+            try:
+                item = _write_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        if batch:
+            try:
+                with _db_lock, _conn:
+                    rows = [row[1:] for row in batch if row[0] == _cache_generation]
+                    _conn.executemany(SQL_CACHE_SET, rows)
+            except Exception as e:
+                print("Cache write error:", repr(e))
+        if flushed is not None:
+            flushed.set()
+
+
+def _cache_flush(timeout: float = 5.0):
+    done = threading.Event()
+    _write_queue.put(done)
+    done.wait(timeout)
+
+
+threading.Thread(target=_cache_writer, name="cache-writer", daemon=True).start()
+
+
+def _cache_pruner():
+    while True:
+        time.sleep(CACHE_PRUNE_INTERVAL_SECONDS)
+        cutoff = int(time.time()) - TTL_SECONDS_FALLBACK
+        try:
+            with _db_lock:
+                with _conn:
+                    _conn.execute(SQL_CACHE_PRUNE, (cutoff,))
+                _conn.execute("PRAGMA incremental_vacuum(100)").fetchall()
+        except Exception as e:
+            print("Cache prune error:", repr(e))
+
+
+threading.Thread(target=_cache_pruner, name="cache-pruner", daemon=True).start()
 
 
 def _cache_clear():
+    global _cache_generation
     with _db_lock:
-        _conn.execute("DELETE FROM cache")
+        _cache_generation += 1
+        _conn.execute(SQL_CACHE_CLEAR)
         _conn.commit()
+    # after the generation bump, so in-flight lookups either land before this or skip the fill
+    with _mem_lock:
+        _mem_cache.clear()
 
 
-# ----------------- HF Space client (lazy) -----------------
+# ----------------- HF Space client (warmed at startup) -----------------
 _hf_client = None
 _hf_lock = threading.Lock()
+# gradio_client only uploads from a path, so stage images on tmpfs when we can
+_UPLOAD_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
 
 
 def _get_hf_client() -> Client:
@@ -144,6 +313,16 @@ def _get_hf_client() -> Client:
         return _hf_client
 
 
+@app.on_event("startup")
+async def _warm_hf_client():
+    if not HF_SPACE_URL:
+        return
+    try:
+        await asyncio.to_thread(_get_hf_client)
+    except Exception as e:
+        print("HF Space warmup error:", repr(e))
+
+
 def generate_keywords_from_image(image_bytes: bytes, filename: str = "image.png") -> str:
     if not HF_SPACE_URL:
         return "used product"
@@ -155,7 +334,7 @@ def generate_keywords_from_image(image_bytes: bytes, filename: str = "image.png"
         if "." in filename:
             suffix = "." + filename.rsplit(".", 1)[1].lower()
 
-        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+        with tempfile.NamedTemporaryFile(suffix=suffix, dir=_UPLOAD_TMP_DIR) as f:
             f.write(image_bytes)
             f.flush()
 
@@ -173,47 +352,64 @@ def generate_keywords_from_image(image_bytes: bytes, filename: str = "image.png"
 
 
 # ----------------- serpapi helpers -----------------
-def _serpapi_call_sold(query: str, limit: int):
+def _retry_after_seconds(r: httpx.Response, default: float) -> float:
+    try:
+        wait = float(r.headers.get("Retry-After", default))
+    except ValueError:
+        wait = default
+    return min(max(wait, 0.0), SERPAPI_MAX_RETRY_WAIT_SECONDS)
+
+
+async def _serpapi_call_sold(query: str, limit: int, etag: Optional[str] = None):
     params = {
         "engine": "ebay",
         "ebay_domain": "ebay.nl",
         "_nkw": query,
         "filters": "Sold,Complete",
         "_ipg": "200",
+        "no_cache": "false",
         "api_key": SERPAPI_KEY,
     }
+    headers = {"If-None-Match": etag} if etag else None
     backoffs = [2, 4, 8]
     last_debug = {}
     for attempt, wait_s in enumerate(backoffs, start=1):
-        r = requests.get("https://serpapi.com/search", params=params, timeout=30)
+        r = await _http.get("https://serpapi.com/search", params=params, headers=headers)
+        try:
+            data = r.json() if r.is_success else None
+        except ValueError:
+            data = None
         last_debug = {
             "attempt": attempt,
             "status_code": r.status_code,
-            "ebay_url": r.json().get("search_metadata", {}).get("ebay_url", "N/A") if r.ok else "N/A",
+            "ebay_url": (data or {}).get("search_metadata", {}).get("ebay_url", "N/A"),
         }
         if r.status_code >= 500:
-            time.sleep(wait_s)
+            if attempt < len(backoffs):
+                await asyncio.sleep(_retry_after_seconds(r, wait_s))
             continue
         break
 
-    if r.status_code != 200:
+    if r.status_code == 304:
+        return None, {"serpapi_debug": last_debug}, etag
+
+    if r.status_code != 200 or data is None:
         raise HTTPException(status_code=502, detail={"reason": "serpapi_failed", "debug": last_debug})
 
-    data = r.json()
     if "error" in data:
         raise HTTPException(status_code=502, detail={"reason": "serpapi_error", "error": data["error"], "debug": last_debug})
 
     items = data.get("organic_results", []) or []
     comps = []
+    append = comps.append
     for it in items:
         price_info = it.get("price", {}) or {}
         extracted = price_info.get("extracted_value") or price_info.get("extracted")
-        raw = price_info.get("raw", "")
-        currency = (price_info.get("currency") or "").upper()
-
         if extracted is None:
             continue
 
+        raw = price_info.get("raw", "")
+        currency = (price_info.get("currency") or "").upper()
         is_eur = currency == "EUR" or "€" in raw or "EUR" in raw.upper()
         if not is_eur:
             continue
@@ -223,29 +419,32 @@ def _serpapi_call_sold(query: str, limit: int):
         except Exception:
             continue
 
-        comps.append({
+        append({
             "title": (it.get("title", "") or "")[:200],
             "price_eur": price_eur,
             "url": it.get("link", ""),
             "condition": it.get("condition", "Onbekend"),
             "source": "ebay_sold_serpapi",
         })
+        if len(comps) == limit:
+            break
 
-    return comps[:limit], {
+    return comps, {
         "count_raw": len(items),
         "count_eur": len(comps),
         "serpapi_debug": last_debug
-    }
+    }, r.headers.get("ETag")
 
 
 # ----------------- main fetch -----------------
-def fetch_ebay_sold(query: str, limit: int = 50):
+async def fetch_ebay_sold(query: str, limit: int = 50):
     if not SERPAPI_KEY:
         raise HTTPException(status_code=400, detail={"reason": "missing_serpapi_key"})
 
     limit = max(1, min(int(limit), 200))
 
-    cached = _cache_get(query, limit)
+    # off the event loop, so the pooled reader connections serve lookups in parallel
+    cached = await asyncio.to_thread(_cache_get, query, limit)
     if cached and cached["age"] <= TTL_SECONDS_DEFAULT:
         cached["data"]["debug"].update({"ttl_seconds": TTL_SECONDS_DEFAULT, "stale": False})
         return cached["data"]
@@ -258,9 +457,15 @@ def fetch_ebay_sold(query: str, limit: int = 50):
         raise HTTPException(status_code=429, detail={"reason": "local_rate_limited", "debug": lim_dbg})
 
     try:
-        comps, dbg = _serpapi_call_sold(query, limit)
+        comps, dbg, etag = await _serpapi_call_sold(query, limit, etag=cached["etag"] if cached else None)
+        if comps is None:
+            # 304: upstream unchanged, keep the cached payload and restart its ttl
+            out = cached["data"]
+            out["debug"].update({"cache": "REVALIDATED", "cache_age_seconds": 0, "ttl_seconds": TTL_SECONDS_DEFAULT, "stale": False} | dbg)
+            _cache_set(query, limit, out, etag=etag)
+            return out
         out = {"items": comps, "debug": {"cache": "MISS", "ttl_seconds": TTL_SECONDS_DEFAULT} | dbg}
-        _cache_set(query, limit, out)
+        _cache_set(query, limit, out, etag=etag)
         return out
     except HTTPException as e:
         if cached:
@@ -270,7 +475,6 @@ def fetch_ebay_sold(query: str, limit: int = 50):
 
 
 # ----------------- analyze endpoint -----------------
-from typing import Optional
 from fastapi import Form
 
 @app.post("/analyze")
@@ -293,19 +497,31 @@ async def analyze_photo(
             )
         image_bytes = await up.read()
         filename = up.filename or "image.png"
-        query = generate_keywords_from_image(image_bytes, filename=filename)
+        query = await asyncio.to_thread(generate_keywords_from_image, image_bytes, filename=filename)
 
     limit = 30
-    result = fetch_ebay_sold(query, limit=limit)
-
-    prices = [item["price_eur"] for item in result.get("items", []) if "price_eur" in item]
-    if prices:
-        avg = sum(prices) / len(prices)
+    result = await fetch_ebay_sold(query, limit=limit)
+
+    total = 0.0
+    count = 0
+    lo = math.inf
+    hi = -math.inf
+    for item in result.get("items", ()):
+        p = item.get("price_eur")
+        if p is None:
+            continue
+        total += p
+        count += 1
+        if p < lo:
+            lo = p
+        if p > hi:
+            hi = p
+    if count:
         result["stats"] = {
-            "average_eur": round(avg, 2),
-            "min_eur": min(prices),
-            "max_eur": max(prices),
-            "count": len(prices)
+            "average_eur": round(total / count, 2),
+            "min_eur": lo,
+            "max_eur": hi,
+            "count": count
         }
 
     result["used_query"] = query
@@ -319,8 +535,8 @@ def ping():
 
 
 @app.get("/debug/ebay")
-def debug_ebay(q: str, limit: int = 50):
-    return fetch_ebay_sold(q, limit=limit)
+async def debug_ebay(q: str, limit: int = 50):
+    return await fetch_ebay_sold(q, limit=limit)
 
 
 @app.get("/debug/cache_clear")
@@ -329,10 +545,13 @@ def cache_clear():
     return {"ok": True, "message": "Cache cleared"}
 
 
-print("\n=== ROUTES LOADED ===")
-for r in app.routes:
-    if isinstance(r, APIRoute):
-        print(f"{','.join(sorted(r.methods))}\t{r.path}\t->\t{r.name}")
-print("=====================\n")
+if LOG_ROUTES:
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.propagate = False
+    for r in app.routes:
+        if isinstance(r, APIRoute):
+            logger.info("route %s\t%s\t->\t%s", ",".join(sorted(r.methods)), r.path, r.name)
 
 